@@ -14,20 +14,28 @@ from Algorithms.utils import layer_init
 from pl_bolts.models.autoencoders.components import resnet18_encoder
 from collections import OrderedDict
 
-def mlp(sizes, activation, output_activation=nn.Identity):
+def mlp(sizes, activation, output_activation=nn.Identity, init_scale=None):
     '''
     Create a multi-layer perceptron model from input sizes and activations
     Args:
         sizes (list): list of number of neurons in each layer of MLP
         activation (nn.modules.activation): Activation function for each layer of MLP
         output_activation (nn.modules.activation): Activation function for the output of the last layer
+        init_scale (list): optional factor for the initial weights of each nn.Linear layer (len(sizes)-1 entries),
+                        applied to the default initialisation while the layer is built
     Return:
         nn.Sequential module for the MLP
     '''
+    init_scale = [1.0]*(len(sizes)-1) if init_scale is None else init_scale
+    assert len(init_scale) == len(sizes)-1, "init_scale needs one entry per nn.Linear layer"
     layers = []
     for j in range(len(sizes)-1):
         act = activation if j<len(sizes)-2 else output_activation
-        layers += [nn.Linear(sizes[j], sizes[j+1]), act()]
+        linear = nn.Linear(sizes[j], sizes[j+1])
+        if init_scale[j] != 1.0:
+            with torch.no_grad():
+                linear.weight.mul_(init_scale[j])
+        layers += [linear, act()]
     return nn.Sequential(*layers)
 
 def cnn(in_channels, conv_layer_sizes, activation, batchnorm=True):
@@ -57,6 +65,60 @@ def cnn(in_channels, conv_layer_sizes, activation, batchnorm=True):
 
   return nn.Sequential(*layers)
 
+def cnn_output_dim(obs_dim, conv_layer_sizes):
+    '''
+    Compute the flattened size of the output of cnn() analytically, without a dummy forward pass.
+    Conv layers in cnn() have no padding and dilation=1, and batchnorm does not change the shape
+    Args:
+        obs_dim (tuple): observation dimension in the form of (C, H, W)
+        conv_layer_sizes (list): list of 3-tuples consisting of
+                                (output_channel, kernel_size, stride)
+    Return:
+        number of elements in the cnn output for a single observation
+    '''
+    C, H, W = obs_dim
+    for out_channel, kernel, stride in conv_layer_sizes:
+        C = out_channel
+        H = (H - kernel)//stride + 1
+        W = (W - kernel)//stride + 1
+    return C * H * W
+
+def fuse_cnn_batchnorm(cnn, linears):
+    '''
+    Fold the (eval mode) BatchNorm2d layers of a cnn() into the layer that consumes their output, for inference.
+    cnn() places batchnorm after the activation, so each batchnorm is folded forward into the next Conv2d,
+    and the last one into the first Linear layer(s) of the MLP(s) reading the flattened cnn output.
+    Only valid because the convolutions in cnn() have no padding.
+    Args:
+        cnn (nn.Sequential): cnn built by cnn()
+        linears (list): first nn.Linear layer of every MLP that takes the flattened cnn output.
+                        These are modified in place
+    Return:
+        nn.Sequential module for the CNN with the batchnorm layers replaced by nn.Identity
+    '''
+    layers = list(cnn)
+    with torch.no_grad():
+        for i, layer in enumerate(layers):
+            if not isinstance(layer, nn.BatchNorm2d):
+                continue
+            assert not layer.training, "Batchnorm layers can only be fused in eval mode"
+            # y = x*scale + shift per channel
+            scale = layer.weight / torch.sqrt(layer.running_var + layer.eps)
+            shift = layer.bias - layer.running_mean * scale
+
+            next_conv = next((l for l in layers[i+1:] if isinstance(l, nn.Conv2d)), None)
+            if next_conv is not None:
+                next_conv.bias += (next_conv.weight * shift.view(1, -1, 1, 1)).sum((1, 2, 3))
+                next_conv.weight *= scale.view(1, -1, 1, 1)
+            else:
+                for linear in linears:
+                    # flattened cnn output is in (C, H, W) order
+                    spatial_size = linear.in_features // scale.shape[0]
+                    linear.bias += linear.weight @ shift.repeat_interleave(spatial_size)
+                    linear.weight *= scale.repeat_interleave(spatial_size).view(1, -1)
+            layers[i] = nn.Identity()
+    return nn.Sequential(*layers)
+
 class VAE(nn.Module):
     def __init__(self, enc_out_dim=512, latent_dim=256, load_path=None, device='cpu'):
         '''
@@ -7,7 +7,7 @@ import os
 import imageio
 
 from Algorithms.utils import get_actor_critic_module, sanitise_state_dict
-from Algorithms.ddpg.replay_buffer import ReplayBuffer
+from Algorithms.ddpg.replay_buffer import ReplayBuffer, PrefetchSampler
 from Logger.logger import Logger
 from copy import deepcopy
 from torch.optim import Adam
@@ -17,7 +17,7 @@ from torch.utils.tensorboard import SummaryWriter
 
 class DDPG:
     def __init__(self, env_fn, save_dir, ac_kwargs=dict(), seed=0, tensorboard_logdir = None,
-         replay_size=int(1e6), gamma=0.99, 
+         replay_size=int(1e6), replay_location=None, gamma=0.99, 
          tau=0.995, pi_lr=1e-3, q_lr=1e-3, batch_size=100, start_steps=10000, 
          update_after=1000, update_every=50, act_noise=0.1, num_test_episodes=10, 
          max_ep_len=1000, logger_kwargs=dict(), save_freq=1, ngpu=1):    
@@ -33,6 +33,8 @@ class DDPG:
                         (3) device='cpu'
             seed (int): seed for random generators
             replay_size (int): Maximum length of replay buffer.
+            replay_location (str): If specified, store the replay buffer as memmapped files
+                in this directory instead of in RAM.
             gamma (float): Discount factor. (Always between 0 and 1.)
             tau (float): Interpolation factor in polyak averaging for target 
                 networks.
@@ -83,7 +85,8 @@ class DDPG:
         
         # Experience buffer
         self.replay_size = replay_size
-        self.replay_buffer = ReplayBuffer(int(replay_size))
+        self.replay_location = replay_location
+        self.replay_buffer = ReplayBuffer(self.env.observation_space.shape, self.env.action_space.shape, int(replay_size), location=replay_location)
 
         # Set up optimizers for actor and critic
         self.pi_lr = pi_lr
@@ -102,6 +105,7 @@ class DDPG:
         self.update_after = update_after
         self.update_every = update_every
         self.batch_size = batch_size
+        self.sampler = PrefetchSampler(self.replay_buffer, self.batch_size, self.device)
         self.save_freq = save_freq
 
         self.best_mean_reward = -np.inf
@@ -123,7 +127,8 @@ class DDPG:
             p.requires_grad = False
         
         # Experience buffer
-        self.replay_buffer = ReplayBuffer(int(self.replay_size))
+        self.replay_buffer = ReplayBuffer(self.env.observation_space.shape, self.env.action_space.shape, int(self.replay_size), location=self.replay_location)
+        self.sampler = PrefetchSampler(self.replay_buffer, self.batch_size, self.device)
 
         # Set up optimizers for actor and critic
         self.pi_optimizer = Adam(self.ac.pi.parameters(), lr=self.pi_lr)
@@ -133,17 +138,12 @@ class DDPG:
         '''
         Do gradient updates for actor-critic models
         Args:
-            experiences: sampled s, a, r, s', terminals from replay buffer.
+            experiences: sampled s, a, r, s', terminals tensors from replay buffer, already on self.device.
         '''
         # Get states, action, rewards, next_states, terminals from experiences
         self.ac.train()
         self.ac_targ.train()
         states, actions, rewards, next_states, terminals = experiences
-        states = torch.from_numpy(states).to(self.device)
-        next_states = torch.from_numpy(next_states).to(self.device)
-        actions = torch.from_numpy(actions).to(self.device)
-        rewards = torch.from_numpy(rewards).to(self.device)
-        terminals = torch.from_numpy(terminals).to(self.device)
 
         # --------------------- Optimizing critic ---------------------
         self.q_optimizer.zero_grad()
@@ -248,7 +248,7 @@ class DDPG:
             'q_optimizer': self.q_optimizer.state_dict()
         }
         torch.save(checkpoint, os.path.join(self.save_dir, _fname))
-        self.replay_buffer.save(os.path.join(self.save_dir, "replay_buffer.pickle"))
+        self.replay_buffer.save(os.path.join(self.save_dir, "replay_buffer.npz"))
         self.env.save(os.path.join(self.save_dir, "env.json"))
         print(f"checkpoint saved at {os.path.join(self.save_dir, _fname)}")
 
@@ -257,7 +257,7 @@ class DDPG:
         Load the model weights and replay buffer from self.save_dir
         Args:
             best (bool): If True, save from the weights file with the best mean episode reward
-            load_buffer (bool): If True, load the replay buffer from the pickled file
+            load_buffer (bool): If True, load the replay buffer from the saved .npz file
         '''
         if best:
             fname = "best.pth"
@@ -266,7 +266,7 @@ class DDPG:
         checkpoint_path = os.path.join(self.save_dir, fname)
         if os.path.isfile(checkpoint_path):
             if load_buffer:
-                self.replay_buffer.load(os.path.join(self.save_dir, "replay_buffer.pickle"))
+                self.replay_buffer.load(os.path.join(self.save_dir, "replay_buffer.npz"))
             key = 'cuda' if torch.cuda.is_available() else 'cpu'
             checkpoint = torch.load(checkpoint_path, map_location=key)
             self.ac.load_state_dict(sanitise_state_dict(checkpoint['ac'], self.ngpu>1))
@@ -310,8 +310,10 @@ class DDPG:
             
             # Update handling
             if timestep>=self.update_after and (timestep+1)%self.update_every==0:
-                for _ in range(self.update_every):
-                    experiences = self.replay_buffer.sample(self.batch_size)
+                for i in range(self.update_every):
+                    # the next minibatch is copied to the gpu while this one is trained on, except after the last
+                    # one of the block, as the replay buffer gets new transitions before the next block
+                    experiences = self.sampler.sample(prefetch_next=i < self.update_every-1)
                     self.update(experiences, timestep)
             
             # End of trajectory/episode handling
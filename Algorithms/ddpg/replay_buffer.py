@@ -1,69 +1,213 @@
 import numpy as np
-from collections import deque
-import random
 import torch
-import pickle
+import os
+
+def combined_shape(length, shape=None):
+    '''
+    Combine the shape with batch size.
+    This is to ensure that the shape will be correct if the act_dim or obs_dim
+    is more than 1D array.
+    '''
+    if shape is None:
+        return (length,)
+    return (length, shape) if np.isscalar(shape) else (length, *shape)
 
 class ReplayBuffer:
     '''
-    A FIFO experience replay buffer to store 
+    A FIFO experience replay buffer to store transitions.
+    Transitions are stored as preallocated arrays (one per field) with a circular
+    write pointer, so appending and sampling never go through python lists.
+    If a location is given, the arrays are np.memmap files on disk instead of in RAM.
     '''
-    def __init__(self, size):
+    def __init__(self, obs_dim, act_dim, size, location=None, name='replay_buffer'):
         """
         Args:
+            obs_dim: dimension size of the observation space
+            act_dim: dimension size of the action space
             size (integer): The size of the replay buffer.
+            location (str): directory to keep the memmapped arrays in. Default None keeps the buffer in RAM
+            name (str): prefix of the memmapped array files, i.e. <location>/<name>.<field>
         """
         size = int(size)
-        self.buffer = deque(maxlen=size)
-        self.max_size = size
-        self.size = 0
+        self.location, self.name = location, name
+        self.states = self._allocate('states', combined_shape(size, obs_dim))
+        self.actions = self._allocate('actions', combined_shape(size, act_dim))
+        self.rewards = self._allocate('rewards', (size,))
+        self.next_states = self._allocate('next_states', combined_shape(size, obs_dim))
+        self.terminals = self._allocate('terminals', (size,))
+        self.ptr, self.size, self.max_size = 0, 0, size
+
+    def _allocate(self, field, shape):
+        '''
+        Allocate the array for one field of the buffer.
+        Existing memmap files are re-mapped (mode='r+') rather than overwritten, so that a
+        restarted process can resume from them with load(). An existing file of a different
+        size (i.e. saved with another replay_size) raises an error instead of being truncated
+        Args:
+            field (str): name of the field, used as the memmap file extension
+            shape (tuple): shape of the array
+        '''
+        if self.location is None:
+            return np.empty(shape, dtype=np.float32)
+        os.makedirs(self.location, exist_ok=True)
+        fname = os.path.join(self.location, f'{self.name}.{field}')
+        nbytes = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        if not os.path.isfile(fname):
+            return np.memmap(fname, dtype=np.float32, mode='w+', shape=shape)
+        if os.path.getsize(fname) != nbytes:
+            raise AssertionError(f"{fname} does not match the replay buffer shape {shape}, "
+                                 "remove it or use the replay_size it was created with")
+        return np.memmap(fname, dtype=np.float32, mode='r+', shape=shape)
 
     def append(self, state, action, reward, next_state, terminal):
         '''
         Args:
-            state (Numpy ndarray): The state.              
+            state (Numpy ndarray): The state.
             action (integer): The action.s
             reward (float): The reward.
-            next_state (Numpy ndarray): The next state. 
+            next_state (Numpy ndarray): The next state.
             terminal (integer): 1 if the next state is a terminal state and 0 otherwise.
         '''
-        if self.size < self.max_size:
-            self.size += 1
-        self.buffer.append([state, action, reward, next_state, terminal])
+        self.states[self.ptr] = state
+        self.actions[self.ptr] = action
+        self.rewards[self.ptr] = reward
+        self.next_states[self.ptr] = next_state
+        self.terminals[self.ptr] = terminal
+        self.ptr = (self.ptr+1) % self.max_size
+        self.size = min(self.size+1, self.max_size)
 
     def sample(self, batch_size):
         '''
-        Randomly sample experiences from replay buffer
+        Randomly sample experiences from replay buffer (with replacement, so the cost
+        scales with batch_size rather than with the size of the buffer)
         Args:
             batch_size (int): number of samples to retrieve from replay buffer
         Returns:
             A list of transition tuples including state, action, reward, next state and terminal
         '''
-        idxs = np.random.choice(self.size, size=batch_size, replace=False)
-        batch = [self.buffer[i] for i in idxs]
-        return [np.asarray(x, dtype="float32") for x in list(zip(*batch))]
-        
-    def size(self):
+        idxs = np.random.randint(0, self.size, size=batch_size)
+        return [arr[idxs] for arr in self._fields()]
+
+    def sample_into(self, batch_size, bufs):
         '''
-        Return the current size of the replay buffer
+        Randomly sample experiences from replay buffer, writing them directly into preallocated buffers
+        (e.g. pinned cpu tensors) instead of allocating new arrays
+        Args:
+            batch_size (int): number of samples to retrieve from replay buffer
+            bufs (tuple): float32 cpu tensors for state, action, reward, next state and terminal,
+                        each of shape (batch_size, *field_shape)
         '''
-        return len(self.buffer)
+        idxs = np.random.randint(0, self.size, size=batch_size)
+        for arr, buf in zip(self._fields(), bufs):
+            np.take(arr, idxs, axis=0, out=buf.numpy())
+        return bufs
+
+    def _fields(self):
+        return [self.states, self.actions, self.rewards, self.next_states, self.terminals]
 
     def save(self, filename):
         '''
-        Save the replay buffer as a python object using pickle
+        Save the filled part of the replay buffer arrays with np.savez.
+        A memmapped buffer is flushed to disk instead, and only the pointers are saved
         Args:
-            filename (str): full path to the saved file to save the replay buffer to
+            filename (str): full path to the saved .npz file to save the replay buffer to
         '''
-        with open(filename, 'wb') as f:
-            pickle.dump(self.buffer, f)
+        if self.location is not None:
+            for arr in self._fields():
+                arr.flush()
+            np.savez(filename, ptr=self.ptr, size=self.size, max_size=self.max_size)
+            return
+
+        np.savez(filename,
+                 states=self.states[:self.size],
+                 actions=self.actions[:self.size],
+                 rewards=self.rewards[:self.size],
+                 next_states=self.next_states[:self.size],
+                 terminals=self.terminals[:self.size],
+                 ptr=self.ptr,
+                 size=self.size,
+                 max_size=self.max_size)
 
     def load(self, filename):
         '''
-        Load the replay buffer as a python object using pickle
+        Load the replay buffer arrays saved with save() into the preallocated arrays.
+        A memmapped buffer already maps the flushed files, so only the pointers are restored
+        Args:
+            filename (str): full path to the saved .npz file to load the replay buffer from
+        '''
+        with np.load(filename) as data:
+            # ptr is only meaningful for a circular buffer of the same capacity
+            assert int(data['max_size']) == self.max_size, "Attempted to load buffer with different max size"
+            self.ptr, self.size = int(data['ptr']), int(data['size'])
+            if self.location is not None:
+                return
+            self.states[:self.size] = data['states']
+            self.actions[:self.size] = data['actions']
+            self.rewards[:self.size] = data['rewards']
+            self.next_states[:self.size] = data['next_states']
+            self.terminals[:self.size] = data['terminals']
+
+class PrefetchSampler:
+    '''
+    Samples minibatches from a replay buffer onto the gpu, double buffered: while the current minibatch
+    is being trained on, the next one is sampled into a pinned cpu buffer and copied to the gpu on a side stream.
+    On cpu it simply samples from the replay buffer
+    '''
+    def __init__(self, replay_buffer, batch_size, device):
+        '''
         Args:
-            filename (str): full path to the saved file to load the replay buffer from
+            replay_buffer (ReplayBuffer): replay buffer to sample from
+            batch_size (int): minibatch size
+            device (str): device to put the minibatches on
+        '''
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.device = device
+        self.enabled = device != 'cpu' and torch.cuda.is_available()
+        if self.enabled:
+            shapes = [(batch_size,) + arr.shape[1:] for arr in replay_buffer._fields()]
+            self.host_bufs = [tuple(torch.empty(shape, dtype=torch.float32, pin_memory=True) for shape in shapes) for _ in range(2)]
+            self.copy_done = [None, None]
+            self.stream = torch.cuda.Stream()
+            self.slot = 0
+            self.next_batch = None
+
+    def _prefetch(self):
         '''
-        with open(filename, 'rb') as f:
-            self.buffer = pickle.load(f)
-        assert self.buffer.maxlen == self.max_size, "Attempted to load buffer with different max size"
+        Sample the next minibatch into the free pinned buffer and start copying it to the gpu
+        '''
+        # the copy out of this pinned buffer from two minibatches ago has to be done before overwriting it
+        if self.copy_done[self.slot] is not None:
+            self.copy_done[self.slot].synchronize()
+        host = self.replay_buffer.sample_into(self.batch_size, self.host_bufs[self.slot])
+        with torch.cuda.stream(self.stream):
+            batch = tuple(t.to(self.device, non_blocking=True) for t in host)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.copy_done[self.slot] = event
+        self.next_batch = (batch, event)
+        self.slot = 1 - self.slot
+
+    def sample(self, prefetch_next=True):
+        '''
+        Args:
+            prefetch_next (bool): If true, start transferring the next minibatch right away. Set it to False for
+                        the last minibatch before the buffer changes, so that no stale minibatch is kept around
+        Return:
+            list of state, action, reward, next state and terminal tensors on the device
+        '''
+        if not self.enabled:
+            return [torch.from_numpy(x).to(self.device) for x in self.replay_buffer.sample(self.batch_size)]
+
+        if self.next_batch is None:
+            self._prefetch()
+        batch, event = self.next_batch
+        self.next_batch = None
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_event(event)
+        for t in batch:
+            # tensors were allocated on the side stream but are used on the current one
+            t.record_stream(current_stream)
+        if prefetch_next:
+            self._prefetch()
+        return list(batch)
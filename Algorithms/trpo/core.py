@@ -4,7 +4,199 @@ import torch
 from gym.spaces import Box, Discrete
 from torch.distributions.categorical import Categorical
 from torch.distributions.normal import Normal
-from Algorithms.body import mlp, cnn, VAE
+from copy import deepcopy
+from itertools import chain
+from dataclasses import dataclass, field
+from Algorithms.body import mlp, cnn, cnn_output_dim, fuse_cnn_batchnorm, VAE
+
+def gaussian_kl(mu_old, std_old, mu, std):
+    '''
+    Closed form kl divergence between old policy and new policy : D( pi_old || pi_new ),
+    summed over the action dimensions and averaged over the batch
+    (https://stats.stackexchange.com/questions/7440/kl-divergence-between-two-univariate-gaussians)
+    Args:
+        mu_old, std_old (Tensor): mean and standard deviation of the old gaussian policy
+        mu, std (Tensor): mean and standard deviation of the new gaussian policy
+    '''
+    kl = torch.log(std/std_old) + (std_old.pow(2)+(mu_old-mu).pow(2))/(2.0*std.pow(2)) - 0.5
+    return kl.sum(-1, keepdim=True).mean()
+
+def categorical_kl(logp_old, logp):
+    '''
+    kl divergence between old policy and new policy : D( pi_old || pi_new ), averaged over the batch.
+    Computed from log probabilities, which avoids the log(p0/p1) of tiny probabilities
+    Args:
+        logp_old (Tensor [n, act_dim]): log probabilities of the old categorical policy
+        logp (Tensor [n, act_dim]): log probabilities of the new categorical policy
+    '''
+    return (logp_old.exp() * (logp_old - logp)).sum(-1).mean()
+
+def reduced_precision_copy(pi, precision, compile_kwargs=None):
+    '''
+    Make a reduced precision copy of an actor for rollouts, the original stays in fp32 for training
+    Args:
+        pi (Actor): actor network to copy
+        precision (str): 'int8' for dynamic int8 quantization of the nn.Linear layers (cpu only),
+                        'bf16' to cast the whole actor to bfloat16
+        compile_kwargs (dict): If specified, compile the copy in place with these torch.compile arguments
+    '''
+    pi = deepcopy(pi).eval()
+    # nn.Module.compile() stores a function bound to the original module, which deepcopy shares,
+    # so the copy would still run the fp32 actor. Drop it and compile the copy on its own
+    pi._compiled_call_impl = None
+    if precision == 'int8':
+        pi = torch.ao.quantization.quantize_dynamic(pi, {nn.Linear}, dtype=torch.qint8)
+    elif precision == 'bf16':
+        pi = pi.to(torch.bfloat16)
+    else:
+        raise AssertionError("Invalid inference_precision. Choose among [None, 'int8', 'bf16']")
+    if compile_kwargs is not None:
+        pi.compile(**compile_kwargs)
+    return pi
+
+class PinnedStaging:
+    '''
+    Host <-> gpu transfers for step() staged through reusable pinned host buffers, so that the copies
+    are asynchronous and all outputs of a step are brought back with a single synchronisation.
+    Falls back to plain .to()/.cpu() copies when running on cpu
+    '''
+    def __init__(self, device):
+        self.device = device
+        self.enabled = device != 'cpu' and torch.cuda.is_available()
+        self.obs_buf = None
+        self.out_bufs = []
+
+    def to_device(self, obs):
+        '''
+        Args:
+            obs (Tensor): observation on the cpu (or already on the device)
+        '''
+        if not self.enabled or obs.is_cuda:
+            return obs.to(self.device)
+        if self.obs_buf is None or self.obs_buf.shape != obs.shape or self.obs_buf.dtype != obs.dtype:
+            self.obs_buf = torch.empty(obs.shape, dtype=obs.dtype, pin_memory=True)
+        self.obs_buf.copy_(obs)
+        return self.obs_buf.to(self.device, non_blocking=True)
+
+    def to_numpy(self, *tensors):
+        '''
+        Args:
+            tensors (Tensor): outputs on the device
+        Return:
+            tuple of numpy arrays (copies, the pinned buffers are reused by the next step)
+        '''
+        if not self.enabled:
+            return tuple(t.cpu().numpy() for t in tensors)
+        if [(b.shape, b.dtype) for b in self.out_bufs] != [(t.shape, t.dtype) for t in tensors]:
+            self.out_bufs = [torch.empty(t.shape, dtype=t.dtype, pin_memory=True) for t in tensors]
+        for buf, t in zip(self.out_bufs, tensors):
+            buf.copy_(t, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+        return tuple(buf.numpy().copy() for buf in self.out_bufs)
+
+def discount_cumsum_chunked(x, discount, chunk_size=256):
+    '''
+    Discounted cumulative sum along the first dim, y[i] = sum_{j>=i} discount^(j-i) * x[j], on the device of x.
+    Each chunk is a single matmul with an upper triangular matrix of discount powers, and the
+    sum of the later chunks is carried backwards, so the cost is one small matmul per chunk_size timesteps
+    Args:
+        x (Tensor [n]): values to accumulate
+        discount (float): discount factor
+        chunk_size (int): number of timesteps accumulated per matmul
+    '''
+    idx = torch.arange(chunk_size, device=x.device)
+    powers = idx.view(1, -1) - idx.view(-1, 1)      # j - i
+    discounts = torch.full((), discount, dtype=x.dtype, device=x.device)
+    discount_mat = torch.where(powers >= 0, discounts.pow(powers.clamp(min=0)), torch.zeros((), dtype=x.dtype, device=x.device))
+    carry_discounts = discounts.pow(chunk_size - idx)   # discount^(m-i) of the carry, for the last m entries
+    y = torch.empty_like(x)
+    carry = torch.zeros((), dtype=x.dtype, device=x.device)
+    for start in reversed(range(0, x.shape[0], chunk_size)):
+        end = min(start + chunk_size, x.shape[0])
+        m = end - start
+        y[start:end] = discount_mat[:m, :m] @ x[start:end] + carry_discounts[chunk_size-m:] * carry
+        carry = y[start]
+    return y
+
+@dataclass
+class TrajectoryBuffer:
+    '''
+    On-policy rollout storage kept on the device as preallocated (size, *shape) tensors, one per field.
+    Timesteps are written by index and the advantages/returns are computed in place,
+    so an update pass reads the whole rollout without collating or copying it
+    Args:
+        obs_shape (tuple): shape of a single observation
+        act_shape (tuple): shape of a single action, () for discrete actions
+        size (int): number of timesteps in a rollout
+        device (str): device to keep the tensors on
+        gamma (float): discount factor for advantage estimation
+        lam (float): lambda for advantage estimation
+    '''
+    obs_shape: tuple
+    act_shape: tuple
+    size: int
+    device: str = 'cpu'
+    gamma: float = 0.99
+    lam: float = 0.97
+    obs: torch.Tensor = field(init=False)
+    act: torch.Tensor = field(init=False)
+    rew: torch.Tensor = field(init=False)
+    val: torch.Tensor = field(init=False)
+    logp: torch.Tensor = field(init=False)
+    adv: torch.Tensor = field(init=False)
+    ret: torch.Tensor = field(init=False)
+    filled: int = field(init=False, default=0)
+
+    def __post_init__(self):
+        self.obs = torch.zeros((self.size, *self.obs_shape), dtype=torch.float32, device=self.device)
+        self.act = torch.zeros((self.size, *self.act_shape), dtype=torch.float32, device=self.device)
+        self.rew, self.val, self.logp, self.adv, self.ret = \
+            torch.zeros((5, self.size), dtype=torch.float32, device=self.device).unbind(0)
+
+    def add(self, t, obs, act, rew, val, logp):
+        '''
+        Write one timestep of agent-environment interaction at index t.
+        Values can be tensors already on the device, they are written without a host synchronisation
+        '''
+        self.obs[t] = torch.as_tensor(obs, device=self.device)
+        self.act[t] = torch.as_tensor(act, device=self.device)
+        self.rew[t] = torch.as_tensor(rew, device=self.device)
+        self.val[t] = torch.as_tensor(val, device=self.device)
+        self.logp[t] = torch.as_tensor(logp, device=self.device)
+        self.filled = max(self.filled, t+1)
+
+    def compute_gae(self, start=0, end=None, last_val=0):
+        '''
+        Compute the GAE-Lambda advantages and the rewards-to-go of the trajectory in [start, end) in place.
+        last_val should be 0 if the trajectory ended in a terminal state, and V(s_T) if it was cut off
+        '''
+        end = self.filled if end is None else end
+        if end <= start:
+            return
+        last_val = torch.as_tensor(last_val, dtype=torch.float32, device=self.device).view(1)
+        rews = torch.cat([self.rew[start:end], last_val])
+        vals = torch.cat([self.val[start:end], last_val])
+
+        deltas = rews[:-1] + self.gamma * vals[1:] - vals[:-1]
+        self.adv[start:end] = discount_cumsum_chunked(deltas, self.gamma * self.lam)
+        self.ret[start:end] = discount_cumsum_chunked(rews, self.gamma)[:-1]
+
+    def normalize_advantages(self):
+        '''
+        Shift the advantages of the filled timesteps to have mean zero and std one
+        '''
+        adv = self.adv[:self.filled]
+        adv.sub_(adv.mean()).div_(adv.std())
+
+def trainable_named_parameters(ac, prefix='', recurse=True, remove_duplicate=True):
+    '''
+    named_parameters() of an actor-critic restricted to its pi and v networks, leaving out the frozen pi_old
+    '''
+    if not recurse:     # the actor-critic has no parameters of its own
+        return iter(())
+    prefix = prefix + '.' if prefix else ''
+    return chain(ac.pi.named_parameters(prefix + 'pi', True, remove_duplicate),
+                 ac.v.named_parameters(prefix + 'v', True, remove_duplicate))
 
 ##########################################################################################################
 #MLP ACTOR-CRITIC##
@@ -58,6 +250,28 @@ class Actor(nn.Module):
             logp_a = self._log_prob_from_distribution(pi, act)
         return pi, logp_a
 
+    @staticmethod
+    def _kl_reference(old_policy, new_policy, fn):
+        '''
+        Run the forward pass needed by calculate_kl on both policies.
+        When both policies are the same network (hessian-vector products), the forward pass is reused and detached.
+        Otherwise the old policy is a frozen reference, evaluated under inference_mode to skip autograd tracking
+        Args:
+            fn (callable): takes a policy, returns a tensor or a tuple of tensors
+        Return:
+            old_out, new_out
+        '''
+        def apply(out, f):
+            return tuple(f(t) for t in out) if isinstance(out, tuple) else f(out)
+
+        new_out = fn(new_policy)
+        if old_policy is new_policy:
+            return apply(new_out, torch.Tensor.detach), new_out
+        with torch.inference_mode():
+            old_out = fn(old_policy)
+        # inference tensors cannot be saved for backward
+        return apply(old_out, torch.Tensor.clone), new_out
+
 class MLPCategoricalActor(Actor):
     '''
     Actor network for discrete outputs
@@ -72,8 +286,8 @@ class MLPCategoricalActor(Actor):
             activation (nn.modules.activation): Activation function for each layer of MLP
         '''
         super().__init__()
-        self.logits_net = mlp([obs_dim] + list(hidden_sizes) + [act_dim], activation)
-        self.logits_net[-2].weight.data /= 100 # last layer is Identity, so we tweak second last layer weights
+        # initialise actor network final layer weights to be 1/100 of other weights
+        self.logits_net = mlp([obs_dim] + list(hidden_sizes) + [act_dim], activation, init_scale=[1.0]*len(hidden_sizes) + [0.01])
 
     def _distribution(self, obs):
         logits = self.logits_net(obs)
@@ -93,10 +307,9 @@ class MLPCategoricalActor(Actor):
         where the distributions are input as log probs.
         """
 
-        p0 = old_policy._distribution(obs).probs.detach() 
-        p1 = new_policy._distribution(obs).probs
-
-        return torch.sum(p0 * torch.log(p0 / p1), 1).mean()
+        # Categorical normalises its logits, so .logits are the log probabilities
+        logp0, logp1 = self._kl_reference(old_policy, new_policy, lambda policy: policy._distribution(obs).logits)
+        return categorical_kl(logp0, logp1)
 
     def dataparallel(self, ngpu):
         print(f"Actor network using {ngpu} gpus, gpu id: {list(range(ngpu))}")
@@ -118,13 +331,20 @@ class MLPGaussianActor(Actor):
         super().__init__()
         log_std = -0.5*np.ones(act_dim, dtype=np.float32)
         self.log_std = torch.nn.Parameter(torch.from_numpy(log_std))
-        self.mu_net = mlp([obs_dim] + list(hidden_sizes) + [act_dim], activation)
-        self.mu_net[-2].weight.data /= 100 # last layer is Identity, so we tweak second last layer weights
-    
+        # initialise actor network final layer weights to be 1/100 of other weights
+        self.mu_net = mlp([obs_dim] + list(hidden_sizes) + [act_dim], activation, init_scale=[1.0]*len(hidden_sizes) + [0.01])
+
+    @property
+    def std(self):
+        return self.log_std.exp()
+
     def _distribution(self, obs):
+        '''
+        Args:
+            obs (Tensor [n, obs_dim]): batch of observation from environment
+        '''
         mu = self.mu_net(obs)
-        std = torch.exp(self.log_std)
-        return Normal(mu, std)
+        return Normal(mu, self.std)
     
     def _log_prob_from_distribution(self, pi, act):
         '''
@@ -135,13 +355,9 @@ class MLPGaussianActor(Actor):
         return pi.log_prob(act).sum(axis=-1)    # last axis sum needed for Torch Normal Distribution
     
     def calculate_kl(self, old_policy, new_policy, obs):
-        mu_old, std_old = old_policy.mu_net(obs).detach(), torch.exp(old_policy.log_std).detach()
-        mu, std = new_policy.mu_net(obs), torch.exp(new_policy.log_std)
-
-        # kl divergence between old policy and new policy : D( pi_old || pi_new )
-        # (https://stats.stackexchange.com/questions/7440/kl-divergence-between-two-univariate-gaussians)
-        kl = torch.log(std/std_old) + (std_old.pow(2)+(mu_old-mu).pow(2))/(2.0*std.pow(2)) - 0.5
-        return kl.sum(-1, keepdim=True).mean()
+        (mu_old, std_old), (mu, std) = self._kl_reference(old_policy, new_policy,
+                                                          lambda policy: (policy.mu_net(obs), policy.std))
+        return gaussian_kl(mu_old, std_old, mu, std)
 
     def dataparallel(self, ngpu):
         print(f"Actor network using {ngpu} gpus, gpu id: {list(range(ngpu))}")
@@ -149,7 +365,8 @@ class MLPGaussianActor(Actor):
 
 class MLPActorCritic(nn.Module):
     def __init__(self, observation_space, action_space, v_hidden_sizes=(256, 256),
-                 pi_hidden_sizes=(64,64), activation=nn.Tanh, device='cpu', ngpu=1, **kwargs):
+                 pi_hidden_sizes=(64,64), activation=nn.Tanh, device='cpu', ngpu=1,
+                 compile_model=False, compile_mode="reduce-overhead", inference_precision=None, **kwargs):
         '''
         A Multi-Layer Perceptron for the Actor_Critic network
         Args:
@@ -158,6 +375,10 @@ class MLPActorCritic(nn.Module):
             hidden_sizes (tuple): list of number of neurons in each layer of MLP
             activation (nn.modules.activation): Activation function for each layer of MLP
             device (str): whether to use cpu or gpu to run the model
+            compile_model (bool): If true, wrap the forward of the actor and critic networks with torch.compile (gpu only)
+            compile_mode (str): mode to pass to torch.compile
+            inference_precision (str): If specified, step() samples from an 'int8' (cpu only) or 'bf16' copy of the actor.
+                        Refresh the copy with update_inference_policy() after every policy update
         '''
         super().__init__()
         obs_dim = observation_space.shape[0]
@@ -177,21 +398,80 @@ class MLPActorCritic(nn.Module):
 
         self.v = MLPCritic(obs_dim, v_hidden_sizes, activation).to(device)
 
+        # pi_old is only a reference for the kl constraint, its weights are copied in and never trained
+        for param in self.pi_old.parameters():
+            param.requires_grad_(False)
+
         self.ngpu = ngpu
         if self.ngpu > 1:
             self.pi.dataparallel(self.ngpu)
             self.pi_old.dataparallel(self.ngpu)
             self.v.dataparallel(self.ngpu)
 
+        self.compile_kwargs = None
+        if compile_model and device != 'cpu':
+            self.compile_kwargs = dict(mode=compile_mode)
+            # Compiled in place so that state_dict keys are unchanged. Only forward() is compiled, the
+            # kl/hessian-vector products call the nets directly and stay eager as they need double backward.
+            # pi_old is only used by the kl, so it is not compiled
+            self.pi.compile(**self.compile_kwargs)
+            self.v.compile(**self.compile_kwargs)
+
+        assert inference_precision != 'int8' or device == 'cpu', "int8 dynamic quantization only runs on cpu"
+        self.inference_precision = inference_precision
+        self.pi_inference = None
+        self.update_inference_policy()
+        self.staging = PinnedStaging(device)
+
+    def update_inference_policy(self):
+        '''
+        Refresh the reduced precision copy of the actor used by step() with the current weights of pi
+        '''
+        if self.inference_precision is not None:
+            self.pi_inference = reduced_precision_copy(self.pi, self.inference_precision, self.compile_kwargs)
+
+    def named_parameters(self, prefix='', recurse=True, remove_duplicate=True):
+        '''
+        Trainable parameters of the actor and critic. pi_old is frozen and left out,
+        but stays in the state_dict so checkpoints are unchanged
+        '''
+        return trainable_named_parameters(self, prefix, recurse, remove_duplicate)
+
+    def parameters(self, recurse=True):
+        return (param for _, param in self.named_parameters(recurse=recurse))
+
+    def _step_tensors(self, obs):
+        '''
+        Sample an action for the given observation and evaluate its value and log probability.
+        Everything stays a tensor on the model's device so this can be traced by torch.compile
+        Return:
+            a, v, logp_a (Tensor)
+        '''
+        if self.pi_inference is not None:
+            pi_net = self.pi_inference
+            # quantized Linear layers only take batched inputs, so run a single observation as a batch of 1
+            single = obs.dim() == 1
+            pi_obs = obs.unsqueeze(0) if single else obs
+            pi, _ = pi_net(pi_obs.to(torch.bfloat16) if self.inference_precision == 'bf16' else pi_obs)
+        else:
+            single = False
+            pi_net = self.pi
+            pi, _ = pi_net(obs)
+        a = pi.sample()
+        logp_a = pi_net._log_prob_from_distribution(pi, a).float()
+        if single:
+            a, logp_a = a.squeeze(0), logp_a.squeeze(0)
+        a = a.float() if a.is_floating_point() else a     # bf16 has no numpy equivalent
+        v = self.v(obs)
+        return a, v, logp_a
+
     def step(self, obs):
+        obs = self.staging.to_device(obs)
         self.pi.eval()
         self.v.eval()
         with torch.no_grad():
-            pi = self.pi._distribution(obs)
-            a = pi.sample()
-            logp_a = self.pi._log_prob_from_distribution(pi, a)
-            v = self.v(obs).detach().cpu().numpy()
-        return a.detach().cpu().numpy(), v, logp_a.cpu().detach().numpy()
+            a, v, logp_a = self._step_tensors(obs)
+        return self.staging.to_numpy(a, v, logp_a)
 
     def act(self, obs):
         return self.step(obs)[0]
@@ -203,7 +483,7 @@ class CNNCritic(nn.Module):
     '''
     A value network for the critic of trpo
     '''
-    def __init__(self, obs_dim, conv_layer_sizes, hidden_sizes, activation):
+    def __init__(self, obs_dim, conv_layer_sizes, hidden_sizes, activation, encoder=None):
         '''
         A Multi-Layer Perceptron for the Critic network
         Args:
@@ -212,23 +492,35 @@ class CNNCritic(nn.Module):
                         that describes the cnn architecture
             hidden_sizes (list): list of number of neurons in each layer of MLP
             activation (nn.modules.activation): Activation function for each layer of MLP
+            encoder (nn.Module): If specified, reuse this cnn (owned by the actor) instead of building one.
+                        Its features are detached, so the critic only trains its MLP head
         '''
         super().__init__()
-        self.v_cnn = cnn(obs_dim[0], conv_layer_sizes, activation, batchnorm=True)
-        self.start_dim = self.calc_shape(obs_dim, self.v_cnn)
+        self.shared_encoder = encoder is not None
+        if self.shared_encoder:
+            self.set_shared_encoder(encoder)
+        else:
+            self.v_cnn = cnn(obs_dim[0], conv_layer_sizes, activation, batchnorm=True)
+        self.start_dim = cnn_output_dim(obs_dim, conv_layer_sizes)
         self.v_mlp = mlp([self.start_dim] + list(hidden_sizes) + [1], activation)
 
-    def calc_shape(self, obs_dim, cnn):
-      '''
-      Function to determine the shape of the data after the conv layers
-      to determine how many neurons for the MLP.
-      '''
-      C, H, W = obs_dim
-      dummy_input = torch.randn(1, C, H, W)
-      with torch.no_grad():
-        cnn_out = cnn(dummy_input)
-      shape = cnn_out.view(-1, ).shape[0]
-      return shape
+    def set_shared_encoder(self, encoder):
+        '''
+        Point the critic at the actor's cnn without registering it as a submodule, so that the cnn
+        stays out of the critic's parameters() and state_dict (it is trained and saved with the actor)
+        '''
+        object.__setattr__(self, 'v_cnn', encoder)
+
+    def features(self, obs):
+        '''
+        Flattened output of the cnn for a batch of observations
+        '''
+        features = self.v_cnn(obs).view(-1, self.start_dim)
+        return features.detach() if self.shared_encoder else features
+
+    def forward_from_features(self, features):
+        v = self.v_mlp(features)
+        return torch.squeeze(v, -1)     # ensure v has the right shape
 
     def forward(self, obs):
         '''
@@ -236,14 +528,21 @@ class CNNCritic(nn.Module):
         Args:
             obs (Tensor [n, obs_dim]): batch of observation from environment
         '''
-        obs = self.v_cnn(obs)
-        obs = obs.view(-1, self.start_dim)
-        v = self.v_mlp(obs)
-        return torch.squeeze(v, -1)     # ensure v has the right shape
+        return self.forward_from_features(self.features(obs))
+
+    def fuse_for_inference(self):
+        '''
+        Fold the batchnorm layers of the cnn into the conv/linear layers after them.
+        Only for inference or export, the network should not be trained afterwards
+        '''
+        assert not self.shared_encoder, "Fuse a shared cnn through CNNActorCritic.fuse_for_inference()"
+        self.eval()
+        self.v_cnn = fuse_cnn_batchnorm(self.v_cnn, [self.v_mlp[0]])
 
     def dataparallel(self, ngpu):
         print(f"Critic network using {ngpu} gpus, gpu id: {list(range(ngpu))}")
-        self.v_cnn = nn.DataParallel(self.v_cnn, list(range(ngpu)))
+        if not self.shared_encoder:    # a shared cnn is wrapped by the actor
+            self.v_cnn = nn.DataParallel(self.v_cnn, list(range(ngpu)))
         self.v_mlp = nn.DataParallel(self.v_mlp, list(range(ngpu)))
 
 class CNNCategoricalActor(Actor):
@@ -267,24 +566,25 @@ class CNNCategoricalActor(Actor):
         super().__init__()
 
         self.logits_cnn = cnn(obs_dim[0], conv_layer_sizes, activation, batchnorm=True)
-        self.start_dim = self.calc_shape(obs_dim, self.logits_cnn)
+        self.start_dim = cnn_output_dim(obs_dim, conv_layer_sizes)
         mlp_sizes = [self.start_dim] + list(hidden_sizes) + [act_dim]
-        self.logits_mlp = mlp(mlp_sizes, activation, output_activation=nn.Tanh)
         # initialise actor network final layer weights to be 1/100 of other weights
-        self.logits_mlp[-2].weight.data /= 100 # last layer is Identity, so we tweak second last layer weights
-
-    def calc_shape(self, obs_dim, cnn):
-      '''
-      Function to determine the shape of the data after the conv layers
-      to determine how many neurons for the MLP.
-      '''
-      C, H, W = obs_dim
-      dummy_input = torch.randn(1, C, H, W)
-      with torch.no_grad():
-        cnn_out = cnn(dummy_input)
-      shape = cnn_out.view(-1, ).shape[0]
-      return shape
-      
+        self.logits_mlp = mlp(mlp_sizes, activation, output_activation=nn.Tanh, init_scale=[1.0]*(len(mlp_sizes)-2) + [0.01])
+
+    @property
+    def encoder(self):
+        return self.logits_cnn
+
+    def features(self, obs):
+        '''
+        Flattened output of the cnn for a batch of observations
+        '''
+        return self.logits_cnn(obs).view(-1, self.start_dim)
+
+    def _distribution_from_features(self, features):
+        logits = self.logits_mlp(features)
+        return Categorical(logits=logits)
+
     def _distribution(self, obs):
         '''
         Forward propagation for actor network
@@ -293,10 +593,7 @@ class CNNCategoricalActor(Actor):
         Return:
             Categorical distribution from output of model
         '''
-        obs = self.logits_cnn(obs)
-        obs = obs.view(-1, self.start_dim)
-        logits = self.logits_mlp(obs)
-        return Categorical(logits=logits)
+        return self._distribution_from_features(self.features(obs))
     
     def _log_prob_from_distribution(self, pi, act):
         '''
@@ -312,10 +609,19 @@ class CNNCategoricalActor(Actor):
         where the distributions are input as log probs.
         """
 
-        p0 = old_policy._distribution(obs).probs.detach() 
-        p1 = new_policy._distribution(obs).probs
+        # Categorical normalises its logits, so .logits are the log probabilities
+        logp0, logp1 = self._kl_reference(old_policy, new_policy, lambda policy: policy._distribution(obs).logits)
+        return categorical_kl(logp0, logp1)
 
-        return torch.sum(p0 * torch.log(p0 / p1), 1).mean()
+    def fuse_for_inference(self, consumers=()):
+        '''
+        Fold the batchnorm layers of the cnn into the conv/linear layers after them.
+        Only for inference or export, the network should not be trained afterwards
+        Args:
+            consumers (list): first nn.Linear of any other MLP reading the output of this cnn
+        '''
+        self.eval()
+        self.logits_cnn = fuse_cnn_batchnorm(self.logits_cnn, [self.logits_mlp[0]] + list(consumers))
 
     def dataparallel(self, ngpu):
         print(f"Actor network using {ngpu} gpus, gpu id: {list(range(ngpu))}")
@@ -345,29 +651,27 @@ class CNNGaussianActor(Actor):
         self.log_std = torch.nn.Parameter(torch.from_numpy(log_std))
         
         self.mu_cnn = cnn(obs_dim[0], conv_layer_sizes, activation, batchnorm=True)
-        self.start_dim = self.calc_shape(obs_dim, self.mu_cnn)
+        self.start_dim = cnn_output_dim(obs_dim, conv_layer_sizes)
         mlp_sizes = [self.start_dim] + list(hidden_sizes) + [act_dim]
-        self.mu_mlp = mlp(mlp_sizes, activation, output_activation=nn.Tanh)
         # initialise actor network final layer weights to be 1/100 of other weights
-        self.mu_mlp[-2].weight.data /= 100 # last layer is Identity, so we tweak second last layer weights
-
-    def calc_shape(self, obs_dim, cnn):
-      '''
-      Function to determine the shape of the data after the conv layers
-      to determine how many neurons for the MLP.
-      '''
-      C, H, W = obs_dim
-      dummy_input = torch.randn(1, C, H, W)
-      with torch.no_grad():
-        cnn_out = cnn(dummy_input)
-      shape = cnn_out.view(-1, ).shape[0]
-      return shape
+        self.mu_mlp = mlp(mlp_sizes, activation, output_activation=nn.Tanh, init_scale=[1.0]*(len(mlp_sizes)-2) + [0.01])
+
+    @property
+    def encoder(self):
+        return self.mu_cnn
+
+    def features(self, obs):
+        '''
+        Flattened output of the cnn for a batch of observations
+        '''
+        return self.mu_cnn(obs).view(-1, self.start_dim)
 
     def forward_mu(self, obs):
-        obs = self.mu_cnn(obs)
-        obs = obs.view(-1, self.start_dim)
-        mu = self.mu_mlp(obs)
-        return mu
+        return self.mu_mlp(self.features(obs))
+
+    @property
+    def std(self):
+        return self.log_std.exp()
 
     def _distribution(self, obs):
         '''
@@ -377,11 +681,11 @@ class CNNGaussianActor(Actor):
         Return:
             Categorical distribution from output of model
         '''
-        obs = self.mu_cnn(obs)
-        obs = obs.view(-1, self.start_dim)
-        mu = self.mu_mlp(obs)
-        std = torch.exp(self.log_std)
-        return Normal(mu, std)
+        return self._distribution_from_features(self.features(obs))
+
+    def _distribution_from_features(self, features):
+        mu = self.mu_mlp(features)
+        return Normal(mu, self.std)
     
     def _log_prob_from_distribution(self, pi, act):
         '''
@@ -392,13 +696,19 @@ class CNNGaussianActor(Actor):
         return pi.log_prob(act).sum(axis=-1)    # last axis sum needed for Torch Normal Distribution
     
     def calculate_kl(self, old_policy, new_policy, obs):
-        mu_old, std_old = old_policy.forward_mu(obs).detach(), torch.exp(old_policy.log_std).detach()
-        mu, std = new_policy.forward_mu(obs), torch.exp(new_policy.log_std)
+        (mu_old, std_old), (mu, std) = self._kl_reference(old_policy, new_policy,
+                                                          lambda policy: (policy.forward_mu(obs), policy.std))
+        return gaussian_kl(mu_old, std_old, mu, std)
 
-        # kl divergence between old policy and new policy : D( pi_old || pi_new )
-        # (https://stats.stackexchange.com/questions/7440/kl-divergence-between-two-univariate-gaussians)
-        kl = torch.log(std/std_old) + (std_old.pow(2)+(mu_old-mu).pow(2))/(2.0*std.pow(2)) - 0.5
-        return kl.sum(-1, keepdim=True).mean()
+    def fuse_for_inference(self, consumers=()):
+        '''
+        Fold the batchnorm layers of the cnn into the conv/linear layers after them.
+        Only for inference or export, the network should not be trained afterwards
+        Args:
+            consumers (list): first nn.Linear of any other MLP reading the output of this cnn
+        '''
+        self.eval()
+        self.mu_cnn = fuse_cnn_batchnorm(self.mu_cnn, [self.mu_mlp[0]] + list(consumers))
 
     def dataparallel(self, ngpu):
         print(f"Actor network using {ngpu} gpus, gpu id: {list(range(ngpu))}")
@@ -407,7 +717,8 @@ class CNNGaussianActor(Actor):
 
 class CNNActorCritic(nn.Module):
     def __init__(self, observation_space, action_space, conv_layer_sizes, v_hidden_sizes=(256, 256), 
-                pi_hidden_sizes=(64,64), activation=nn.Tanh, device='cpu', ngpu=1, **kwargs):
+                pi_hidden_sizes=(64,64), activation=nn.Tanh, device='cpu', ngpu=1,
+                compile_model=False, compile_mode="reduce-overhead", share_cnn=False, inference_precision=None, **kwargs):
         '''
         A CNN Perceptron for the Actor_Critic network
         Args:
@@ -419,6 +730,12 @@ class CNNActorCritic(nn.Module):
             pi_hidden_sizes (tuple): list of number of neurons in each layer of MLP in policy network
             activation (nn.modules.activation): Activation function for each layer of MLP
             device (str): whether to use cpu or gpu to run the model
+            compile_model (bool): If true, wrap the forward of the actor and critic networks with torch.compile (gpu only)
+            compile_mode (str): mode to pass to torch.compile
+            share_cnn (bool): If true, the critic reuses the cnn of the actor (trained by the policy update only)
+                        instead of its own. pi_old keeps its own cnn as a snapshot for the kl constraint
+            inference_precision (str): If specified, step() samples from an 'int8' (cpu only) or 'bf16' copy of the actor.
+                        Refresh the copy with update_inference_policy() after every policy update
         '''
         super().__init__()
         obs_dim = observation_space.shape
@@ -436,25 +753,105 @@ class CNNActorCritic(nn.Module):
             self.pi = CNNCategoricalActor(obs_dim, act_dim, conv_layer_sizes, pi_hidden_sizes, activation).to(device)
             self.pi_old = CNNCategoricalActor(obs_dim, act_dim, conv_layer_sizes, pi_hidden_sizes, activation).to(device)
 
-        self.v = CNNCritic(obs_dim, conv_layer_sizes, v_hidden_sizes, activation).to(device)
+        self.share_cnn = share_cnn
+        encoder = self.pi.encoder if self.share_cnn else None
+        self.v = CNNCritic(obs_dim, conv_layer_sizes, v_hidden_sizes, activation, encoder=encoder).to(device)
+
+        # pi_old is only a reference for the kl constraint, its weights are copied in and never trained
+        for param in self.pi_old.parameters():
+            param.requires_grad_(False)
 
         self.ngpu = ngpu
         if self.ngpu > 1:
             self.pi.dataparallel(self.ngpu)
             self.pi_old.dataparallel(self.ngpu)
             self.v.dataparallel(self.ngpu)
+            if self.share_cnn:
+                self.v.set_shared_encoder(self.pi.encoder)
+
+        self.compile_kwargs = None
+        if compile_model and device != 'cpu':
+            # CUDA graphs from reduce-overhead do not play well with the batchnorm layers switching
+            # between train/eval, so keep the other inductor optimisations but turn cudagraphs off
+            if compile_mode == "reduce-overhead":
+                self.compile_kwargs = dict(options={"triton.cudagraphs": False})
+            else:
+                self.compile_kwargs = dict(mode=compile_mode)
+            # Compiled in place so that state_dict keys are unchanged. Only forward() is compiled, the
+            # kl/hessian-vector products call the nets directly and stay eager as they need double backward.
+            # pi_old is only used by the kl, so it is not compiled
+            self.pi.compile(**self.compile_kwargs)
+            self.v.compile(**self.compile_kwargs)
+
+        # convolutions are not quantized by int8 dynamic quantization, only the MLP head is
+        assert inference_precision != 'int8' or device == 'cpu', "int8 dynamic quantization only runs on cpu"
+        self.inference_precision = inference_precision
+        self.pi_inference = None
+        self.update_inference_policy()
+        self.staging = PinnedStaging(device)
+
+    def update_inference_policy(self):
+        '''
+        Refresh the reduced precision copy of the actor used by step() with the current weights of pi
+        '''
+        if self.inference_precision is not None:
+            self.pi_inference = reduced_precision_copy(self.pi, self.inference_precision, self.compile_kwargs)
+
+    def named_parameters(self, prefix='', recurse=True, remove_duplicate=True):
+        '''
+        Trainable parameters of the actor and critic. pi_old is frozen and left out,
+        but stays in the state_dict so checkpoints are unchanged
+        '''
+        return trainable_named_parameters(self, prefix, recurse, remove_duplicate)
+
+    def parameters(self, recurse=True):
+        return (param for _, param in self.named_parameters(recurse=recurse))
+
+    def _step_tensors(self, obs):
+        '''
+        Sample an action for a batch of observations and evaluate its value and log probability.
+        Everything stays a tensor on the model's device so this can be traced by torch.compile
+        Return:
+            a, v, logp_a (Tensor)
+        '''
+        pi_net = self.pi
+        if self.pi_inference is not None:
+            pi_net = self.pi_inference
+            pi, _ = pi_net(obs.to(torch.bfloat16) if self.inference_precision == 'bf16' else obs)
+            v = self.v(obs)
+        elif self.share_cnn:
+            # run the shared cnn once for both the actor and critic heads
+            features = self.pi.features(obs)
+            pi = self.pi._distribution_from_features(features)
+            v = self.v.forward_from_features(features)
+        else:
+            pi, _ = self.pi(obs)
+            v = self.v(obs)
+        a = pi.sample().squeeze()
+        logp_a = pi_net._log_prob_from_distribution(pi, a).float()
+        a = a.float() if a.is_floating_point() else a     # bf16 has no numpy equivalent
+        return a, v, logp_a
+
+    def fuse_for_inference(self):
+        '''
+        Fold the batchnorm layers of the actor and critic cnns into the layers after them, to speed up step().
+        Only for inference or export (call before torch.compile), the model should not be trained afterwards
+        '''
+        if self.share_cnn:
+            self.pi.fuse_for_inference(consumers=[self.v.v_mlp[0]])
+            self.v.set_shared_encoder(self.pi.encoder)
+            self.v.eval()
+        else:
+            self.pi.fuse_for_inference()
+            self.v.fuse_for_inference()
 
     def step(self, obs):
-        obs = obs.unsqueeze(0)
+        obs = self.staging.to_device(obs).unsqueeze(0)
         self.pi.eval()
         self.v.eval()
         with torch.no_grad():
-            pi = self.pi._distribution(obs)
-            a = pi.sample().squeeze()
-            # print(a.shape)
-            logp_a = self.pi._log_prob_from_distribution(pi, a)
-            v = self.v(obs).detach().cpu().numpy()
-        return a.detach().cpu().numpy(), v, logp_a.cpu().detach().numpy()
+            a, v, logp_a = self._step_tensors(obs)
+        return self.staging.to_numpy(a, v, logp_a)
 
     def act(self, obs):
         return self.step(obs)[0]
@@ -511,10 +908,8 @@ class VAECategoricalActor(Actor):
         self.logits_vae = VAE()
         self.logits_vae.load_weights(vae_weights_path)
         mlp_sizes = [self.logits_vae.latent_dim] + list(hidden_sizes) + [act_dim]
-        self.logits_mlp = mlp(mlp_sizes, activation, output_activation=nn.Tanh)
-
         # initialise actor network final layer weights to be 1/100 of other weights
-        self.logits_mlp[-2].weight.data /= 100 # last layer is Identity, so we tweak second last layer weights
+        self.logits_mlp = mlp(mlp_sizes, activation, output_activation=nn.Tanh, init_scale=[1.0]*(len(mlp_sizes)-2) + [0.01])
 
     def _distribution(self, obs):
         '''
@@ -560,9 +955,8 @@ class VAEGaussianActor(Actor):
 
         self.mu_vae = VAE()
         mlp_sizes = [self.mu_vae.latent_dim] + list(hidden_sizes) + [act_dim]
-        self.mu_mlp = mlp(mlp_sizes, activation, output_activation=nn.Tanh)
         # initialise actor network final layer weights to be 1/100 of other weights
-        self.mu_mlp[-2].weight.data /= 100 # last layer is Identity, so we tweak second last layer weights
+        self.mu_mlp = mlp(mlp_sizes, activation, output_activation=nn.Tanh, init_scale=[1.0]*(len(mlp_sizes)-2) + [0.01])
 
     def _distribution(self, obs):
         '''
@@ -630,17 +1024,18 @@ class VAEActorCritic(nn.Module):
             self.pi.dataparallel(self.ngpu)
             self.pi_old.dataparallel(self.ngpu)
             self.v.dataparallel(self.ngpu)
+        self.staging = PinnedStaging(device)
 
     def step(self, obs):
-        obs = obs.unsqueeze(0)
+        obs = self.staging.to_device(obs).unsqueeze(0)
         self.pi.eval()
         self.v.eval()
         with torch.no_grad():
             pi = self.pi._distribution(obs)
             a = pi.sample().squeeze()
             logp_a = self.pi._log_prob_from_distribution(pi, a)
-            v = self.v(obs).detach().cpu().numpy()
-        return a.detach().cpu().numpy(), v, logp_a.cpu().detach().numpy()
+            v = self.v(obs)
+        return self.staging.to_numpy(a, v, logp_a)
 
     def act(self, obs):
         return self.step(obs)[0]
@@ -1,7 +1,11 @@
 import numpy as np
 import random
 import torch
-from copy import deepcopy
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 def combined_shape(length, shape=None):
     '''
@@ -13,7 +17,7 @@ def combined_shape(length, shape=None):
         return (length,)
     return (length, shape) if np.isscalar(shape) else (length, *shape)
 
-def discount_cumsum(x, discount):
+def _discount_cumsum(x, discount):
     """
     input: 
         vector x, 
@@ -25,13 +29,17 @@ def discount_cumsum(x, discount):
          x1 + discount * x2,
          x2]
     """
-    running_sum = 0
-    output = deepcopy(x)
-    for i in reversed(range(len(x))):
-        output[i] += running_sum*discount
-        running_sum = output[i]
+    running_sum = 0.0
+    output = np.empty_like(x)
+    for i in range(len(x)-1, -1, -1):
+        running_sum = x[i] + running_sum*discount
+        output[i] = running_sum
     return output
 
+# The reverse recursion carries a dependency between iterations, so it cannot be parallelised with prange,
+# but compiling it with numba removes the python interpreter overhead of the loop (numba is optional)
+discount_cumsum = njit(cache=True)(_discount_cumsum) if njit is not None else _discount_cumsum
+
 class GAEBuffer:
     """
     A buffer for storing trajectories experienced by a TRPO agent interacting
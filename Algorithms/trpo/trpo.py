@@ -261,9 +261,14 @@ class TRPO:
                         self.update_model(self.ac.pi, params)
 
             # Update Critic
+            share_cnn = getattr(self.ac, 'share_cnn', False)
+            if share_cnn:
+                # the shared cnn is not trained by the critic, so its features are fixed over the critic updates
+                with torch.no_grad():
+                    features = self.ac.v.features(obs)
             for _ in range(self.train_v_iters):
                 self.v_optimizer.zero_grad()
-                v = self.ac.v(obs)
+                v = self.ac.v.forward_from_features(features) if share_cnn else self.ac.v(obs)
                 v_loss = ((v-ret)**2).mean()
                 v_loss.backward()
                 self.v_optimizer.step()
@@ -306,6 +311,8 @@ class TRPO:
             self.ac.v.load_state_dict(sanitise_state_dict(checkpoint['v'], self.ngpu>1))
             self.ac.pi.load_state_dict(sanitise_state_dict(checkpoint['pi'], self.ngpu>1))
             self.v_optimizer.load_state_dict(sanitise_state_dict(checkpoint['v_optimizer'], self.ngpu>1))
+            if hasattr(self.ac, 'update_inference_policy'):
+                self.ac.update_inference_policy()
 
             env_path = os.path.join(self.save_dir, "env.json")
             if os.path.isfile(env_path):
@@ -327,7 +334,8 @@ class TRPO:
             for t in range(self.steps_per_epoch):
                 # step the environment
                 obs = np.asarray(obs,dtype="float32")
-                a, v, logp = self.ac.step(torch.from_numpy(obs).to(self.device))
+                # step() moves the observation to the device itself, through pinned memory when on gpu
+                a, v, logp = self.ac.step(torch.from_numpy(obs))
                 next_obs, reward, done, _ = self.env.step(a)
                 ep_ret += reward
                 ep_len += 1
@@ -343,7 +351,7 @@ class TRPO:
                 # End of trajectory/episode handling
                 if terminal or epoch_ended:
                     if timeout or epoch_ended:
-                        obs = torch.from_numpy(np.asarray(obs,dtype="float32")).to(self.device)
+                        obs = torch.from_numpy(np.asarray(obs,dtype="float32"))
                         _, v, _ = self.ac.step(obs)
                     else:
                         v = 0
@@ -373,6 +381,8 @@ class TRPO:
 
             # update value function and TRPO policy update
             self.update()
+            if hasattr(self.ac, 'update_inference_policy'):
+                self.ac.update_inference_policy()
             self.logger.dump()
             if self.save_freq > 0 and epoch % self.save_freq == 0:
                 self.save_weights(fname=f"latest_{trial_num}.pth")
@@ -421,7 +431,7 @@ class TRPO:
         if timesteps is not None:
             for i in range(timesteps):
                 # Take stochastic action with policy network
-                obs = torch.from_numpy(np.asarray(obs,dtype="float32")).to(self.device)
+                obs = torch.from_numpy(np.asarray(obs,dtype="float32"))
                 action, _, _ = self.ac.step(obs)
                 obs, reward, done, _ = self.env.step(action)
                 if record:
@@ -433,7 +443,7 @@ class TRPO:
         else:
             while not (done or (ep_len==self.max_ep_len)):
                 # Take stochastic action with policy network
-                obs = torch.from_numpy(np.asarray(obs,dtype="float32")).to(self.device)
+                obs = torch.from_numpy(np.asarray(obs,dtype="float32"))
                 action, _, _ = self.ac.step(obs)
                 obs, reward, done, _ = self.env.step(action)
                 if record:
@@ -1,6 +1,7 @@
 import gym
 import numpy as np
 import pickle
+import json
 from typing import Tuple
 from gym.spaces import Box
 
@@ -20,17 +21,26 @@ class RLBench_Wrapper(gym.ObservationWrapper):
                         'left_shoulder-rgbd', 'right_shoulder-rgbd', 'wrist-rgbd', 'front-rgbd']
         '''
         super(RLBench_Wrapper, self).__init__(env)
+        self.set_view(view)
+
+    def set_view(self, view):
+        '''
+        Select the camera view and build the matching observation space
+        Args:
+            view (str): Dictionary key to specify which camera view to use, e.g. 'front-rgb'
+        '''
         self.view, self.viewtype = view.split('-')
         if self.viewtype == 'rgb':
             # swap (128, 128, 3) into (3, 128, 128) for torch input
-            H, W, C = self.observation_space[self.view+'_rgb'].shape
+            H, W, C = self.env.observation_space[self.view+'_rgb'].shape
             self.observation_space = Box(0.0, 1.0, (C, H, W), dtype=np.float32)
         elif self.viewtype == 'rgbd':
             # swap (128, 128, 3) and (128, 128) into (4, 128, 128) for torch input
-            H, W, C = self.observation_space[self.view+'_rgb'].shape
+            H, W, C = self.env.observation_space[self.view+'_rgb'].shape
             self.observation_space = Box(0.0, 1.0, (C+1, H, W), dtype=np.float32)
+            self.rgb_channels = C
         else:
-            self.observation_space = self.observation_space[view]
+            self.observation_space = self.env.observation_space[view]
 
     def reset(self, **kwargs):
         observation = self.env.reset(**kwargs)
@@ -39,17 +49,46 @@ class RLBench_Wrapper(gym.ObservationWrapper):
     def observation(self, observation):
         #print(observation.keys())
         if self.viewtype == 'rgb':
-            return observation[self.view+'_rgb'].transpose([2, 0, 1])
+            # single explicit copy into contiguous (C, H, W) memory, ready for torch.from_numpy
+            return np.ascontiguousarray(observation[self.view+'_rgb'].transpose([2, 0, 1]), dtype=np.float32)
         elif self.viewtype == 'rgbd':
-            rgbd_obs = np.dstack((observation[self.view+'_rgb'], observation[self.view+'_depth']))
-            print(rgbd_obs.transpose([2, 0, 1]).shape)
-            return rgbd_obs.transpose([2, 0, 1])
+            # write rgb and depth straight into a contiguous (C+1, H, W) array, instead of
+            # stacking into (H, W, C+1) and returning a non-contiguous transposed view.
+            # A new array is used every step as agents keep both the current and next observation
+            rgbd_obs = np.empty(self.observation_space.shape, dtype=np.float32)
+            np.copyto(rgbd_obs[:self.rgb_channels], observation[self.view+'_rgb'].transpose([2, 0, 1]))
+            rgbd_obs[self.rgb_channels] = observation[self.view+'_depth']
+            return rgbd_obs
         elif self.viewtype == 'depth':
             return observation[self.view+'_depth']
     
     def save(self, fname):
-        return
+        '''
+        Save the camera view, observation space shape and the numpy random state as json,
+        the same format as the other wrappers use for the agents' env.json.
+        Observations are not cached, so there are no buffers to save
+        '''
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        state = {
+            "view": self.view,
+            "viewtype": self.viewtype,
+            "obs_space_shape": list(self.observation_space.shape),
+            "rng": {"keys": keys.tolist(), "pos": pos, "has_gauss": has_gauss, "cached_gaussian": cached_gaussian}
+        }
+        with open(fname, 'w') as f:
+            f.write(json.dumps(state, indent=4))
 
     # @classmethod
     def load(self, filename):
-        return
+        '''
+        Restore the camera view and the numpy random state saved with save()
+        Return:
+            the wrapper itself, as the agents reassign self.env = self.env.load(...)
+        '''
+        with open(filename, 'r') as f:
+            state = json.load(f)
+        self.set_view(f"{state['view']}-{state['viewtype']}")
+        assert tuple(state['obs_space_shape']) == self.observation_space.shape, "Saved env has a different observation space"
+        rng = state['rng']
+        np.random.set_state(('MT19937', np.array(rng['keys'], dtype=np.uint32), rng['pos'], rng['has_gauss'], rng['cached_gaussian']))
+        return self
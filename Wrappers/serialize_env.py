@@ -1,6 +1,7 @@
 import gym
 import numpy as np
 import pickle
+import json
 from typing import Tuple
 
 class Serialize_Env(gym.ObservationWrapper):
@@ -18,8 +19,28 @@ class Serialize_Env(gym.ObservationWrapper):
         return observation
 
     def save(self, fname):
-        return
+        '''
+        Save the observation space shape and the numpy random state as json,
+        the same format as the other wrappers use for the agents' env.json
+        '''
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        state = {
+            "obs_space_shape": list(self.observation_space.shape),
+            "rng": {"keys": keys.tolist(), "pos": pos, "has_gauss": has_gauss, "cached_gaussian": cached_gaussian}
+        }
+        with open(fname, 'w') as f:
+            f.write(json.dumps(state, indent=4))
 
     # @classmethod
     def load(self, filename):
-        return
\ No newline at end of file
+        '''
+        Restore the numpy random state saved with save()
+        Return:
+            the wrapper itself, as the agents reassign self.env = self.env.load(...)
+        '''
+        with open(filename, 'r') as f:
+            state = json.load(f)
+        assert tuple(state['obs_space_shape']) == self.observation_space.shape, "Saved env has a different observation space"
+        rng = state['rng']
+        np.random.set_state(('MT19937', np.array(rng['keys'], dtype=np.uint32), rng['pos'], rng['has_gauss'], rng['cached_gaussian']))
+        return self
@@ -1,5 +1,6 @@
 import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageSequence
 
 def parse_arguments():
@@ -9,6 +10,27 @@ def parse_arguments():
     parser.add_argument('--out', type=str, required=True, help='path to output gif')
     return parser.parse_args()
 
+def load_frames(path):
+    '''
+    Decode every frame of a gif, keeping the mode of the frames.
+    Gif frames are stored as deltas of the previous frame, so frames of one file
+    are decoded sequentially in a single pass
+    Args:
+        path (str): path to the gif
+    Return:
+        list of PIL images
+    '''
+    with Image.open(path) as gif:
+        return [frame.copy() for frame in ImageSequence.Iterator(gif)]
+
+def share_palette(imgs):
+    '''
+    Check if all frames are palette ('P' mode) images with the same palette,
+    in which case they can be saved as a gif without converting them
+    '''
+    palette = imgs[0].getpalette() if imgs[0].mode == 'P' else None
+    return palette is not None and all(img.mode == 'P' and img.getpalette() == palette for img in imgs)
+
 def main():
     args = parse_arguments()
 
@@ -17,19 +39,16 @@ def main():
     if not os.path.isfile(args.gif2):
         raise AssertionError(f"{args.gif2} not found.")
 
-    gif1 = Image.open(args.gif1)
-    gif2 = Image.open(args.gif2)
-    print(f'gif1 has: {gif1.n_frames} frames')
-    print(f'gif2 has: {gif2.n_frames} frames')
-
-    imgs = []
-    for frame in range(gif1.n_frames):
-        gif1.seek(frame)
-        imgs.append(gif1.convert('RGBA'))
-    for frame in range(gif2.n_frames):
-        gif2.seek(frame)
-        imgs.append(gif2.convert("RGBA"))
-    
+    # decode both gifs in parallel, one process each
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        frames1, frames2 = executor.map(load_frames, [args.gif1, args.gif2])
+    print(f'gif1 has: {len(frames1)} frames')
+    print(f'gif2 has: {len(frames2)} frames')
+
+    imgs = frames1 + frames2
+    # Only convert when the frames cannot be saved with a single palette
+    if not share_palette(imgs):
+        imgs = [img.convert('RGBA') for img in imgs]
     imgs[0].save(args.out, save_all=True, append_images=imgs[1:], 
                 optimize=False, duration=100, loop=0)
 